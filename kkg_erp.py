@@ -4,11 +4,16 @@
 
 import streamlit as st
 import sqlite3
-import pandas as pd
 import datetime
 import hashlib
-import uuid
+import hmac
+import itertools
+import os
+import queue
+import threading
+import time
 import traceback
+from collections import Counter
 from typing import Dict, List, Tuple
 
 # =========================================================
@@ -19,6 +24,11 @@ st.set_page_config(page_title="KKG Enterprise OS", layout="wide")
 
 DB_FILE = "kkg_enterprise.db"
 
+PAGE_SIZE = 50
+
+# read-only connections alongside the single writer
+READERS = 4
+
 META = {
     "brand": "Kisan Khidmat Ghar",
     "location": "Chakoora Pulwama",
@@ -29,51 +39,144 @@ META = {
 # INDUSTRIAL DATABASE ENGINE
 # =========================================================
 
+class _Rejected(Exception):
+    # internal to run_many: unwinds `with conn` so the transaction rolls back
+    pass
+
 class EnterpriseDB:
 
     def __init__(self):
-        self.conn = self._connect()
+        self.conn = self._connect(DB_FILE)
+        # one writer connection shared by every session thread
+        self.lock = threading.Lock()
+
+        # WAL lets these read their own snapshot while the writer commits;
+        # opened after the writer so the file is already in WAL mode
+        self.readers = queue.Queue()
+        for _ in range(READERS):
+            self.readers.put(self._connect(f"file:{DB_FILE}?mode=ro", uri=True))
+
+    def _connect(self, target, uri=False):
+        # per-connection compiled statement cache; queries are constant strings
+        conn = sqlite3.connect(
+            target,
+            uri=uri,
+            check_same_thread=False,
+            cached_statements=256
+        )
+        # C-level rows with r['col'] access; no dict built per row
+        conn.row_factory = sqlite3.Row
+
+        conn.execute("PRAGMA cache_size=-65536")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=268435456")
 
-    def _connect(self):
-        return sqlite3.connect(DB_FILE, check_same_thread=False)
+        if not uri:
+            # WAL: readers don't block the POS writer, NORMAL: one fsync per checkpoint
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA wal_autocheckpoint=1000")
+
+        return conn
 
     def run(self, query, params=(), fetch=False):
         try:
-            cur = self.conn.cursor()
-            cur.execute(query, params)
-
-            if fetch:
-                cols = [c[0] for c in cur.description]
-                res = [dict(zip(cols, r)) for r in cur.fetchall()]
-                cur.close()
-                return res
+            if fetch and query.lstrip()[:6].upper().startswith(("SELECT", "WITH")):
+                # plain reads borrow a reader and skip the writer lock
+                conn = self.readers.get()
+                try:
+                    cur = conn.execute(query, params)
+                    rows = cur.fetchall()
+                finally:
+                    self.readers.put(conn)
             else:
-                self.conn.commit()
-                cur.close()
-                return True
+                # commits on success, rolls back on error
+                with self.lock, self.conn:
+                    cur = self.conn.execute(query, params)
+                    if not fetch:
+                        return True
+                    rows = cur.fetchall()
+
+            if fetch == "cols":
+                # column -> values, handed straight to st.dataframe
+                cols = [c[0] for c in cur.description]
+                return dict(zip(cols, map(list, zip(*rows)))) if rows else {}
+            return rows
 
         except Exception as e:
             print("DB ERROR:", e)
             print(traceback.format_exc())
-            return [] if fetch else False
+            # None, not []: callers must tell a failed read from an empty one
+            return None if fetch else False
+
+    def run_many(self, steps):
+        # steps: [(query, seq_of_params[, expected_rowcount]), ...]
+        # one transaction, one commit. True once committed; None when a
+        # rowcount guard rejected it (rolled back, an expected outcome such
+        # as an oversell, so not logged); False on a DB error
+        try:
+            with self.lock, self.conn:
+                cur = self.conn.cursor()
+                # wait for the write lock before any statement runs
+                cur.execute("BEGIN IMMEDIATE")
+                for query, rows, *expect in steps:
+                    cur.executemany(query, rows)
+                    if expect and cur.rowcount != expect[0]:
+                        # leaving the with-block by exception rolls back
+                        raise _Rejected
+            return True
+
+        except _Rejected:
+            return None
+
+        except Exception as e:
+            print("DB ERROR:", e)
+            print(traceback.format_exc())
+            return False
+
+    def script(self, sql):
+        # multi-statement migrations; the script carries its own BEGIN/COMMIT
+        with self.lock:
+            try:
+                self.conn.executescript(sql)
+                return True
+
+            except Exception as e:
+                if self.conn.in_transaction:
+                    self.conn.rollback()
+                print("DB ERROR:", e)
+                print(traceback.format_exc())
+                return False
 
-db = EnterpriseDB()
+@st.cache_resource
+def get_db():
+    # script reruns on every interaction; keep one connection per process
+    return EnterpriseDB()
+
+db = get_db()
+
+def require(result, step):
+    # db.run/db.script swallow errors (False, or None for a read); raise
+    # where a cached or stamped result must not record the failure
+    if result is None or result is False:
+        raise sqlite3.OperationalError(f"{step} failed")
+    return result
 
 # =========================================================
 # SCHEMA INIT
 # =========================================================
 
-def init_schema():
+SCHEMA = {
 
-    db.run("""
+    "users": """
     CREATE TABLE IF NOT EXISTS users(
         username TEXT PRIMARY KEY,
         password TEXT,
         role TEXT
     )
-    """)
+    """,
 
-    db.run("""
+    "products": """
     CREATE TABLE IF NOT EXISTS products(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         name TEXT,
@@ -82,18 +185,18 @@ def init_schema():
         stock INTEGER,
         min_stock INTEGER
     )
-    """)
+    """,
 
-    db.run("""
+    "customers": """
     CREATE TABLE IF NOT EXISTS customers(
         phone TEXT PRIMARY KEY,
         name TEXT,
         credit_limit REAL,
         joined TEXT
     )
-    """)
+    """,
 
-    db.run("""
+    "transactions": """
     CREATE TABLE IF NOT EXISTS transactions(
         id TEXT PRIMARY KEY,
         phone TEXT,
@@ -101,11 +204,11 @@ def init_schema():
         paid REAL,
         due REAL,
         type TEXT,
-        created TEXT
+        created INTEGER
     )
-    """)
+    """,
 
-    db.run("""
+    "tx_items": """
     CREATE TABLE IF NOT EXISTS tx_items(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         tx_id TEXT,
@@ -114,26 +217,90 @@ def init_schema():
         price REAL,
         cost REAL
     )
-    """)
+    """,
 
-    db.run("""
+    "expenses": """
     CREATE TABLE IF NOT EXISTS expenses(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         amount REAL,
         category TEXT,
-        created TEXT
+        created INTEGER
     )
-    """)
+    """,
 
-    db.run("""
+    "audit": """
     CREATE TABLE IF NOT EXISTS audit(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         user TEXT,
         action TEXT,
         details TEXT,
-        created TEXT
+        created INTEGER
     )
-    """)
+    """
+}
+
+def migrate_epoch():
+    # created used to be TEXT holding str(datetime.now()) in local time;
+    # rebuild those tables with INTEGER epoch seconds
+    for table in ("transactions", "expenses", "audit"):
+
+        info = db.run(f"PRAGMA table_info({table})", fetch=True)
+        if not info:
+            return False
+        if not any(c['name'] == 'created' and c['type'] == 'TEXT' for c in info):
+            continue
+
+        cols = [c['name'] for c in info]
+        conv = [
+            "CAST(strftime('%s', created, 'utc') AS INTEGER)" if c == 'created' else c
+            for c in cols
+        ]
+
+        if not db.script(f"""
+            BEGIN;
+            ALTER TABLE {table} RENAME TO {table}_old;
+            {SCHEMA[table]};
+            INSERT INTO {table}({", ".join(cols)})
+                SELECT {", ".join(conv)} FROM {table}_old;
+            DROP TABLE {table}_old;
+            COMMIT;
+        """):
+            return False
+
+    return True
+
+# bump whenever SCHEMA, the migrations or the indexes below change
+SCHEMA_VERSION = 1
+
+def upgrade_schema():
+
+    for table, ddl in SCHEMA.items():
+        require(db.run(ddl), f"create {table}")
+
+    # before the indexes: a rebuilt table drops its old ones
+    require(migrate_epoch(), "epoch migration")
+
+    for sql in (
+        # covering: the dashboard's daily SUMs read the index, never the table
+        "CREATE INDEX IF NOT EXISTS idx_tx_type_created_total ON transactions(type, created, total)",
+        "CREATE INDEX IF NOT EXISTS idx_exp_created_amount ON expenses(created, amount)"
+    ):
+        require(db.run(sql), sql)
+
+    # only once every step above has succeeded
+    require(db.run(f"PRAGMA user_version={SCHEMA_VERSION}"), "user_version")
+
+@st.cache_resource
+def init_schema():
+
+    # warm database: one PRAGMA read instead of the full DDL pass
+    if require(db.run("PRAGMA user_version", fetch=True), "user_version")[0][0] < SCHEMA_VERSION:
+        upgrade_schema()
+
+    # sampled stats so the planner prefers the indexes; every process start,
+    # since a fresh install would otherwise keep the stats of empty tables
+    db.run("PRAGMA analysis_limit=400")
+    db.run("ANALYZE")
 
 init_schema()
 
@@ -141,16 +308,42 @@ init_schema()
 # SECURITY + AUDIT
 # =========================================================
 
-def hash_pass(p):
-    return hashlib.sha256(p.encode()).hexdigest()
+def hash_pass(p, salt=None):
+    # scrypt$salt$key -- salted, memory-hard (16 MB per check)
+    salt = salt or os.urandom(16).hex()
+    key = hashlib.scrypt(p.encode(), salt=bytes.fromhex(salt), n=2**14, r=8, p=1, dklen=32)
+    return "scrypt$" + salt + "$" + key.hex()
+
+def check_pass(p, stored):
+    if stored.startswith("scrypt$"):
+        salt = stored.split("$")[1]
+        return hmac.compare_digest(stored, hash_pass(p, salt))
+    # legacy unsalted digest; login upgrades it to scrypt
+    return hmac.compare_digest(stored, hashlib.sha256(p.encode()).hexdigest())
+
+@st.cache_resource
+def seed_users():
+    # empty install: default admin so the first login is possible
+    if not db.run("SELECT 1 FROM users LIMIT 1", fetch=True):
+        db.run(
+            "INSERT OR IGNORE INTO users VALUES(?,?,?)",
+            ("admin", hash_pass("kkg@123"), "admin")
+        )
+
+seed_users()
 
 def audit(action, details):
     user = st.session_state.get("user","system")
-    db.run(
-        "INSERT INTO audit VALUES(NULL,?,?,?,?)",
-        (user, action, details, str(datetime.datetime.now()))
+    # buffered; flush_audit() writes a run's entries in one commit
+    st.session_state.setdefault("audit_buf", []).append(
+        (user, action, details, int(time.time()))
     )
 
+def flush_audit():
+    buf = st.session_state.get("audit_buf")
+    if buf and db.run_many([("INSERT INTO audit VALUES(NULL,?,?,?,?)", buf)]):
+        st.session_state.audit_buf = []
+
 # =========================================================
 # FINANCE ENGINE (REAL PROFIT LOGIC)
 # =========================================================
@@ -158,38 +351,47 @@ def audit(action, details):
 class FinanceEngine:
 
     @staticmethod
-    def today_profit():
-
-        today = str(datetime.date.today())
-
-        sales = db.run(
-            "SELECT SUM(total) v FROM transactions WHERE type='SALE' AND created LIKE ?",
-            (today+"%",), True
+    @st.cache_data(ttl=60)
+    def snapshot(today):
+        # keyed by date: a new day never serves yesterday's figures
+        day = tuple(
+            int(time.mktime((today + datetime.timedelta(days=d)).timetuple()))
+            for d in (0, 1)
         )
 
-        exp = db.run(
-            "SELECT SUM(amount) v FROM expenses WHERE created LIKE ?",
-            (today+"%",), True
-        )
-
-        sales = sales[0]['v'] if sales and sales[0]['v'] else 0
-        exp = exp[0]['v'] if exp and exp[0]['v'] else 0
-
-        return sales-exp
+        # every dashboard figure in one round-trip; [local midnight, next
+        # midnight) epoch ranges seek the created indexes
+        res = require(db.run("""
+            SELECT
+                (SELECT COALESCE(SUM(total),0) FROM transactions
+                    WHERE type='SALE' AND created >= ? AND created < ?) sales_today,
+                (SELECT COALESCE(SUM(amount),0) FROM expenses
+                    WHERE created >= ? AND created < ?) exp_today,
+                (SELECT COALESCE(SUM((price-cost)*qty),0) FROM tx_items) margin,
+                (SELECT COALESCE(SUM(amount),0) FROM expenses) exp_total
+        """, day + day, True), "finance snapshot")
+
+        # plain dict: st.cache_data pickles the return value
+        return dict(res[0])
 
     @staticmethod
-    def real_profit():
-
-        items = db.run("SELECT qty, price, cost FROM tx_items", fetch=True)
+    def today_profit(snap=None):
+        snap = snap or FinanceEngine.snapshot(datetime.date.today())
+        return snap['sales_today'] - snap['exp_today']
 
-        profit = 0
-        for i in items:
-            profit += (i['price'] - i['cost']) * i['qty']
-
-        exp = db.run("SELECT SUM(amount) v FROM expenses", fetch=True)
-        exp = exp[0]['v'] if exp and exp[0]['v'] else 0
-
-        return profit - exp
+    @staticmethod
+    def real_profit(snap=None):
+        snap = snap or FinanceEngine.snapshot(datetime.date.today())
+        return snap['margin'] - snap['exp_total']
+
+def refresh_data(finance=False, lookups=False):
+    # clear only what a write touched; the rest stays warm
+    if finance:
+        FinanceEngine.snapshot.clear()
+    if lookups:
+        pos_lookup.clear()
+    # every write lands in some displayed table
+    cached_query.clear()
 
 # =========================================================
 # AUTH
@@ -204,9 +406,12 @@ def login_ui():
 
     if st.button("Login"):
 
-        res = db.run("SELECT * FROM users WHERE username=?", (u,), True)
+        res = db.run("SELECT password, role FROM users WHERE username=?", (u,), True)
 
-        if res and res[0]['password'] == hash_pass(p):
+        if res and check_pass(p, res[0]['password']):
+            if not res[0]['password'].startswith("scrypt$"):
+                # upgrade older hashes on first successful login
+                db.run("UPDATE users SET password=? WHERE username=?", (hash_pass(p), u))
             st.session_state.user = u
             st.session_state.role = res[0]['role']
             audit("LOGIN", u)
@@ -214,6 +419,25 @@ def login_ui():
         else:
             st.error("Invalid login")
 
+# =========================================================
+# TABLE PAGING
+# =========================================================
+
+@st.cache_data(ttl=300)
+def cached_query(query, params=()):
+    # display reads, shared across sessions; column dicts pickle cheaply
+    return require(db.run(query, params, fetch="cols"), "display read")
+
+def paged(query, count, key):
+    # page picker + one LIMIT/OFFSET page of query (which ends in ORDER BY)
+    pages = max(1, -(-count // PAGE_SIZE))
+    page = st.number_input("Page", min_value=1, max_value=pages, step=1, key=key)
+
+    return cached_query(
+        query + " LIMIT ? OFFSET ?",
+        (PAGE_SIZE, (page-1)*PAGE_SIZE)
+    )
+
 # =========================================================
 # DASHBOARD
 # =========================================================
@@ -222,8 +446,9 @@ def dashboard():
 
     st.title("🚀 Business Command Center")
 
-    profit_today = FinanceEngine.today_profit()
-    profit_real = FinanceEngine.real_profit()
+    snap = FinanceEngine.snapshot(datetime.date.today())
+    profit_today = FinanceEngine.today_profit(snap)
+    profit_real = FinanceEngine.real_profit(snap)
 
     c1,c2 = st.columns(2)
 
@@ -234,6 +459,7 @@ def dashboard():
 # INVENTORY
 # =========================================================
 
+@st.fragment
 def inventory_ui():
 
     st.header("📦 Inventory")
@@ -249,16 +475,28 @@ def inventory_ui():
                 (n,p,c,s,5)
             )
             audit("ADD_PRODUCT", n)
+            refresh_data(lookups=True)
             st.success("Added")
 
-    prods = db.run("SELECT * FROM products", fetch=True)
+    count = cached_query("SELECT COUNT(*) n FROM products")
+
+    # one page per rerun; ORDER BY id walks the primary key, no sort
+    prods = paged(
+        "SELECT id, name, price, cost, stock FROM products ORDER BY id",
+        count['n'][0] if count else 0,
+        "inv_page"
+    )
     if prods:
-        st.dataframe(pd.DataFrame(prods))
+        st.dataframe(prods)
+
+    # fragment reruns skip the script-level flush
+    flush_audit()
 
 # =========================================================
 # CUSTOMERS
 # =========================================================
 
+@st.fragment
 def customers_ui():
 
     st.header("👥 Customers")
@@ -268,92 +506,175 @@ def customers_ui():
         ph = st.text_input("Phone")
         lim = st.number_input("Credit Limit", 50000)
         if st.form_submit_button("Add"):
-            db.run(
-                "INSERT INTO customers VALUES(?,?,?,?)",
-                (ph,name,lim,str(datetime.date.today()))
+            added = db.run(
+                "INSERT INTO customers VALUES(?,?,?,?) "
+                "ON CONFLICT(phone) DO NOTHING RETURNING phone",
+                (ph,name,lim,str(datetime.date.today())),
+                True
             )
-            audit("ADD_CUSTOMER", ph)
+            if added:
+                audit("ADD_CUSTOMER", ph)
+                refresh_data(lookups=True)
+                st.success("Added")
+            elif added is None:
+                st.error("Customer not saved: database error")
+            else:
+                st.error("Phone number already exists")
 
-    data = db.run("SELECT * FROM customers", fetch=True)
+    data = cached_query("SELECT phone, name, credit_limit, joined FROM customers")
     if data:
-        st.dataframe(pd.DataFrame(data))
+        st.dataframe(data)
+
+    flush_audit()
 
 # =========================================================
 # POS ENGINE
 # =========================================================
 
+@st.cache_resource(ttl=300)
+def pos_lookup():
+
+    # shared read-only across sessions: no pickle copy per rerun,
+    # so rows stay sqlite3.Row; callers must not mutate them
+    # keyed by id/phone so a selection survives a cache refill
+    prods = require(db.run("SELECT id, name, price, cost FROM products", fetch=True), "product lookup")
+    custs = require(db.run("SELECT phone, name FROM customers", fetch=True), "customer lookup")
+    prods = {p['id']: p for p in prods}
+    custs = {c['phone']: c for c in custs}
+
+    # selectbox labels, formatted once per cache fill
+    plabels = {k: f"{p['name']} (₹{p['price']:,.0f})" for k, p in prods.items()}
+    clabels = {k: f"{c['name']} ({k})" for k, c in custs.items()}
+
+    return prods, plabels, custs, clabels
+
+@st.cache_resource
+def tx_seq():
+    # per-process counter; the script body reruns, so it can't be a plain global
+    return itertools.count()
+
+def new_cart():
+    # one list per column; line i is the i-th entry of each
+    return {"id": [], "name": [], "qty": [], "price": [], "cost": []}
+
+def stock_decrement(need):
+    # one guarded UPDATE for the whole cart from its per-id tally; a row
+    # is skipped unless stock covers the total
+    case = "CASE id " + " ".join("WHEN ? THEN ?" for _ in need) + " END"
+    pairs = [v for kv in need.items() for v in kv]
+    query = (
+        f"UPDATE products SET stock = stock - {case} "
+        f"WHERE id IN ({','.join('?' * len(need))}) AND stock >= {case}"
+    )
+
+    return query, pairs + list(need) + pairs, len(need)
+
+def short_stock(need):
+    # ids whose current stock can't cover the tally, to explain a rejected sale
+    rows = require(db.run(
+        f"SELECT id, stock FROM products WHERE id IN ({','.join('?' * len(need))})",
+        list(need),
+        fetch=True
+    ), "stock check")
+    have = {r['id']: r['stock'] for r in rows}
+    return [pid for pid, q in need.items() if have.get(pid, 0) < q]
+
+def clear_cart():
+    st.session_state.cart = new_cart()
+    st.session_state.cart_total = 0
+    st.session_state.cart_qty = Counter()
+
 def pos_ui():
 
     st.header("🛒 POS Terminal")
 
-    prods = db.run("SELECT * FROM products", True)
-    custs = db.run("SELECT * FROM customers", True)
+    prods, plabels, custs, clabels = pos_lookup()
 
     if not prods or not custs:
         st.warning("Need products + customers")
         return
 
-    pmap = {p['name']:p for p in prods}
-    cmap = {c['name']:c for c in custs}
-
-    cust = st.selectbox("Customer", list(cmap.keys()))
-    prod = st.selectbox("Product", list(pmap.keys()))
+    # keyed: the widget keeps its selection when a refill changes the options
+    cust = custs[st.selectbox("Customer", list(custs), format_func=clabels.__getitem__, key="pos_cust")]
+    item = prods[st.selectbox("Product", list(prods), format_func=plabels.__getitem__, key="pos_prod")]
     qty = st.number_input("Qty", 1)
 
     if st.button("Add Item"):
 
         if "cart" not in st.session_state:
-            st.session_state.cart = []
+            clear_cart()
+
+        # running total and per-id tally, so reruns never re-scan the cart
+        st.session_state.cart_total += qty*item['price']
+        st.session_state.cart_qty[item['id']] += qty
 
-        item = pmap[prod]
+        cart = st.session_state.cart
+        cart['id'].append(item['id'])
+        cart['name'].append(item['name'])
+        cart['qty'].append(qty)
+        cart['price'].append(item['price'])
+        cart['cost'].append(item['cost'])
 
-        st.session_state.cart.append({
-            "name": prod,
-            "qty": qty,
-            "price": item['price'],
-            "cost": item['cost']
-        })
+    if "cart" in st.session_state and st.session_state.cart['id']:
 
-    if "cart" in st.session_state and st.session_state.cart:
+        cart = st.session_state.cart
 
-        df = pd.DataFrame(st.session_state.cart)
-        st.dataframe(df)
+        # columns go to the table as-is, no per-line dicts to unpack
+        st.dataframe({k: cart[k] for k in ("name", "qty", "price")})
 
-        total = (df.qty * df.price).sum()
+        total = st.session_state.cart_total
 
         paid = st.number_input("Paid", 0.0)
 
+        if st.button("Clear Cart"):
+            clear_cart()
+            st.rerun()
+
         if st.button("Finalize Sale"):
 
-            txid = str(uuid.uuid4())
+            # time-ordered key: inserts append to the primary-key B-tree;
+            # the sequence keeps it unique on coarse clocks (~15 ms on Windows)
+            txid = f"TX-{time.time_ns():019d}-{next(tx_seq()) % 10000:04d}"
+            stock_sql, stock_params, stock_rows = stock_decrement(st.session_state.cart_qty)
 
-            db.run(
-                "INSERT INTO transactions VALUES(?,?,?,?,?,?,?)",
+            ok = db.run_many([
+                (
+                    "INSERT INTO transactions VALUES(?,?,?,?,?,?,?)",
+                    [(
+                        txid,
+                        cust['phone'],
+                        total,
+                        paid,
+                        total-paid,
+                        "SALE",
+                        int(time.time())
+                    )]
+                ),
                 (
-                    txid,
-                    cmap[cust]['phone'],
-                    total,
-                    paid,
-                    total-paid,
-                    "SALE",
-                    str(datetime.datetime.now())
-                )
-            )
-
-            for i in st.session_state.cart:
-                db.run(
                     "INSERT INTO tx_items VALUES(NULL,?,?,?,?,?)",
-                    (txid,i['name'],i['qty'],i['price'],i['cost'])
+                    [(txid,n,q,pr,c) for n,q,pr,c in zip(cart['name'],cart['qty'],cart['price'],cart['cost'])]
+                ),
+                (stock_sql, [stock_params], stock_rows)
+            ])
+
+            if ok is None:
+                # the stock guard skipped a line; name what is short
+                names = dict(zip(cart['id'], cart['name']))
+                st.error(
+                    "Sale not saved: not enough stock for "
+                    + ", ".join(f"{names[i]} (id {i})" for i in short_stock(st.session_state.cart_qty))
+                    + ". Clear the cart and re-add within stock."
                 )
+                return
 
-                db.run(
-                    "UPDATE products SET stock=stock-? WHERE name=?",
-                    (i['qty'],i['name'])
-                )
+            if not ok:
+                st.error("Sale not saved: database error")
+                return
 
             audit("SALE", txid)
+            refresh_data(finance=True)
 
-            st.session_state.cart = []
+            clear_cart()
             st.success("Sale Done")
             st.rerun()
 
@@ -361,6 +682,7 @@ def pos_ui():
 # EXPENSES
 # =========================================================
 
+@st.fragment
 def expense_ui():
 
     st.header("💸 Expenses")
@@ -371,13 +693,27 @@ def expense_ui():
         if st.form_submit_button("Add"):
             db.run(
                 "INSERT INTO expenses VALUES(NULL,?,?,?)",
-                (amt,cat,str(datetime.datetime.now()))
+                (amt,cat,int(time.time()))
             )
             audit("ADD_EXP", cat)
+            refresh_data(finance=True)
 
-    data = db.run("SELECT * FROM expenses", True)
+    # totals in SQL; only the visible page is fetched, newest first
+    stats = cached_query("SELECT COUNT(*) n, COALESCE(SUM(amount),0) spent FROM expenses")
+    n, spent = (stats['n'][0], stats['spent'][0]) if stats else (0, 0)
+
+    st.metric("Total Expenses", f"₹{spent:,.0f}")
+
+    data = paged(
+        "SELECT datetime(created, 'unixepoch', 'localtime') created, category, amount "
+        "FROM expenses ORDER BY id DESC",
+        n,
+        "exp_page"
+    )
     if data:
-        st.dataframe(pd.DataFrame(data))
+        st.dataframe(data)
+
+    flush_audit()
 
 # =========================================================
 # MAIN ROUTER
@@ -414,4 +750,8 @@ def main():
 # =========================================================
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    finally:
+        # also runs when a handler ends with st.rerun()
+        flush_audit()